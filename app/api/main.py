@@ -1,17 +1,26 @@
+import asyncio
 import csv
 import io
 import os
 import hashlib
+import json
+import logging
+import time
+from array import array
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import date, datetime
-from typing import List, Tuple, Optional
+from functools import lru_cache
+from typing import Iterable, List, Tuple, Optional
 
 from fastapi import FastAPI, File, Form, Request, UploadFile
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import URL, make_url, text
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine
 
 
 # ----------------------------
@@ -25,9 +34,58 @@ if not DATABASE_URL:
 # Set STORE_ROW_AUDIT=1 if you want per-row history.
 STORE_ROW_AUDIT = os.getenv("STORE_ROW_AUDIT", "0").strip() == "1"
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+# Audit rows are written after the response; pending batches wait here
+# (one JSONL file per batch) so a worker restart doesn't lose them.
+# Must be persistent storage shared by all workers (the Docker image mounts
+# a volume and points this at it).
+AUDIT_SPOOL_DIR = os.getenv("AUDIT_SPOOL_DIR", "audit_spool")
 
-app = FastAPI(title="NPC EA Household Upload")
+# A spool file whose batch row isn't visible may belong to an upload that is
+# still committing (in any worker); it is only treated as orphaned (upload
+# rolled back / process died before commit) once it is older than this,
+# far longer than any upload transaction.
+AUDIT_ORPHAN_GRACE = 3600  # seconds
+AUDIT_RETRY_DELAY = 30  # seconds between attempts for a batch not yet written
+
+# Per-worker memory of recent batches, so a double-clicked "Upload" is
+# answered without a DB round trip. Entries are only trusted for a few
+# seconds: after that the DB decides (the batch may have been deleted, or
+# lost in a crash with synchronous_commit off).
+RECENT_BATCHES_MAX = 1024
+RECENT_BATCH_TTL = 10.0  # seconds
+
+logger = logging.getLogger(__name__)
+
+
+def async_database_url(url: str) -> URL:
+    """
+    DATABASE_URL is a plain postgresql:// (libpq style) URL; run it on asyncpg.
+    asyncpg takes libpq's sslmode values under the name `ssl`.
+    """
+    u = make_url(url).set(drivername="postgresql+asyncpg")
+    if "sslmode" in u.query:
+        u = u.update_query_dict({"ssl": u.query["sslmode"]}).difference_update_query(["sslmode"])
+    return u
+
+
+engine = create_async_engine(
+    async_database_url(DATABASE_URL),
+    pool_pre_ping=True,
+    # shows up in pg_stat_activity (who holds a lock / ran the DDL)
+    connect_args={"server_settings": {"application_name": "npc-ea-upload"}},
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await init_db()
+    await start_audit_worker(app)
+    yield
+    await stop_audit_worker(app)
+
+
+# JSON endpoints (/health, /routes) serialize with orjson instead of stdlib json
+app = FastAPI(title="NPC EA Household Upload", default_response_class=ORJSONResponse, lifespan=lifespan)
 templates = Jinja2Templates(directory="templates")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -35,10 +93,31 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 # ----------------------------
 # DB init
 # ----------------------------
-def init_db():
-    with engine.begin() as conn:
+# Bump whenever the DDL in init_db changes, so existing databases re-run it.
+SCHEMA_VERSION = 2
+
+# pg_advisory_xact_lock key: serializes init_db across workers booting together
+SCHEMA_LOCK_ID = 7_315_001
+
+
+async def schema_is_current() -> bool:
+    async with engine.connect() as conn:
+        if (await conn.execute(text("SELECT to_regclass('schema_version')"))).scalar() is None:
+            return False
+        cur_ver = (await conn.execute(text("SELECT MAX(v) FROM schema_version"))).scalar()
+        return (cur_ver or 0) >= SCHEMA_VERSION
+
+
+async def init_db():
+    # Fast path for every boot after the first: no DDL, no locks
+    if await schema_is_current():
+        return
+
+    async with engine.begin() as conn:
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": SCHEMA_LOCK_ID})
+
         # Master table
-        conn.execute(text("""
+        await conn.execute(text("""
         CREATE TABLE IF NOT EXISTS ea_frame (
           NAT_EA_SN TEXT PRIMARY KEY,
           HOUSEHOLD_COUNT INTEGER,
@@ -50,7 +129,7 @@ def init_db():
         """))
 
         # Batch table
-        conn.execute(text("""
+        await conn.execute(text("""
         CREATE TABLE IF NOT EXISTS upload_batches (
           id BIGSERIAL PRIMARY KEY,
           client_name TEXT NOT NULL,
@@ -69,13 +148,20 @@ def init_db():
         );
         """))
 
-        conn.execute(text("""
-        CREATE UNIQUE INDEX IF NOT EXISTS ux_batch_dedupe
-        ON upload_batches (client_name, client_project, collection_date, file_hash);
+        # Covering unique index: the duplicate-batch lookup (id, created_at)
+        # is answered from the index alone. Replaces the older ux_batch_dedupe.
+        await conn.execute(text("""
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_batch_dedupe_cov
+        ON upload_batches (client_name, client_project, collection_date, file_hash)
+        INCLUDE (id, created_at);
+        """))
+
+        await conn.execute(text("""
+        DROP INDEX IF EXISTS ux_batch_dedupe;
         """))
 
         # Upload history (may already exist from old versions)
-        conn.execute(text("""
+        await conn.execute(text("""
         CREATE TABLE IF NOT EXISTS ea_uploads (
           id BIGSERIAL PRIMARY KEY,
           NAT_EA_SN TEXT NOT NULL,
@@ -90,14 +176,14 @@ def init_db():
         """))
 
         # ✅ Migration: add batch_id column if missing
-        conn.execute(text("""
+        await conn.execute(text("""
         ALTER TABLE ea_uploads
         ADD COLUMN IF NOT EXISTS batch_id BIGINT;
         """))
 
         # ✅ Add FK only if not already present
         # (Postgres doesn't have IF NOT EXISTS for ADD CONSTRAINT, so we guard it)
-        conn.execute(text("""
+        await conn.execute(text("""
         DO $$
         BEGIN
           IF NOT EXISTS (
@@ -112,92 +198,381 @@ def init_db():
         """))
 
         # Indexes
-        conn.execute(text("""
+        await conn.execute(text("""
         CREATE INDEX IF NOT EXISTS ix_upload_batch_id
         ON ea_uploads (batch_id);
         """))
 
-        conn.execute(text("""
+        await conn.execute(text("""
         CREATE INDEX IF NOT EXISTS ix_upload_nat_ea_sn
         ON ea_uploads (NAT_EA_SN);
         """))
 
-
-
-@app.on_event("startup")
-def _startup():
-    init_db()
+        # Migration marker checked by schema_is_current()
+        await conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+          v INTEGER NOT NULL
+        );
+        """))
+        await conn.execute(text("DELETE FROM schema_version"))
+        await conn.execute(text("INSERT INTO schema_version (v) VALUES (:v)"), {"v": SCHEMA_VERSION})
 
 
 # ----------------------------
 # Helpers
 # ----------------------------
-def normalize_csv_bytes(file_bytes: bytes) -> bytes:
-    """
-    Normalize CSV for stable hashing:
-    - decode utf-8-sig to drop BOM
-    - normalize line endings to \n
-    - strip trailing spaces on lines
-    """
-    txt = file_bytes.decode("utf-8-sig", errors="replace")
-    txt = txt.replace("\r\n", "\n").replace("\r", "\n")
-    lines = [ln.rstrip() for ln in txt.split("\n")]
-    norm = "\n".join(lines).strip() + "\n"
-    return norm.encode("utf-8")
-
-
-def sha256_hex(b: bytes) -> str:
-    return hashlib.sha256(b).hexdigest()
-
-
-def parse_csv_file(file_bytes: bytes) -> Tuple[Optional[List[Tuple[str, int]]], Optional[str], int]:
+def parse_csv_file(lines: Iterable[str]) -> Tuple[Optional[List[str]], Optional[array], Optional[str], int]:
     """
     Expected columns: NAT_EA_SN,HOUSEHOLD_COUNT
-    Returns: (rows, error_message, duplicates_in_file)
+    Returns: (nats, household_counts, error_message, duplicates_in_file)
+
+    Rows come back as two parallel columns (a list of NAT_EA_SN strings and
+    a compact int32 array of counts) rather than a list of tuples.
     """
-    text_stream = io.StringIO(file_bytes.decode("utf-8-sig", errors="replace"))
-    reader = csv.DictReader(text_stream)
+    # Positional reader: columns are located once from the header instead of
+    # building a dict per row.
+    reader = csv.reader(lines)
+    header = [c.strip() for c in next(reader, None) or []]
 
     required = {"NAT_EA_SN", "HOUSEHOLD_COUNT"}
-    if not reader.fieldnames:
-        return None, "Your CSV looks empty. Please use the provided template.", 0
+    if not header:
+        return None, None, "Your CSV looks empty. Please use the provided template.", 0
 
-    cols = set([c.strip() for c in reader.fieldnames])
-    missing = required - cols
+    missing = required - set(header)
     if missing:
-        return None, f"Missing column(s): {', '.join(sorted(missing))}. Required: NAT_EA_SN, HOUSEHOLD_COUNT.", 0
+        return None, None, f"Missing column(s): {', '.join(sorted(missing))}. Required: NAT_EA_SN, HOUSEHOLD_COUNT.", 0
+
+    i_nat = header.index("NAT_EA_SN")
+    i_hh = header.index("HOUSEHOLD_COUNT")
+    width = max(i_nat, i_hh) + 1
 
-    rows: List[Tuple[str, int]] = []
+    nats: List[str] = []
+    hhs = array("i")  # same range as the INTEGER column
+    # Exact set rather than a Bloom filter: a false positive would silently
+    # drop a valid row, and the set only references the strings already kept
+    # in `nats` (one hash-table slot per row, no second copy of the text).
     seen_in_file = set()
     dup_in_file = 0
 
+    # Hot loop: bind the per-row methods once instead of looking them up per row
+    _strip = str.strip
+    nats_append = nats.append
+    hhs_append = hhs.append
+    seen_add = seen_in_file.add  # membership stays `in`: the operator beats a bound __contains__ call
+
     for i, r in enumerate(reader, start=2):
-        nat = (r.get("NAT_EA_SN") or "").strip()
-        hh_raw = (r.get("HOUSEHOLD_COUNT") or "").strip()
+        if len(r) < width:
+            if not r:
+                continue  # blank line
+            r += [""] * (width - len(r))
+
+        nat = _strip(r[i_nat])
+        hh_raw = _strip(r[i_hh])
 
         if not nat:
-            return None, f"Row {i}: NAT_EA_SN is empty.", dup_in_file
+            return None, None, f"Row {i}: NAT_EA_SN is empty.", dup_in_file
 
         if nat in seen_in_file:
             dup_in_file += 1
             # skip duplicates inside file
             continue
-        seen_in_file.add(nat)
+        seen_add(nat)
 
         try:
             hh = int(hh_raw)
         except Exception:
-            return None, f"Row {i}: HOUSEHOLD_COUNT must be a whole number.", dup_in_file
+            return None, None, f"Row {i}: HOUSEHOLD_COUNT must be a whole number.", dup_in_file
 
         if hh < 0:
-            return None, f"Row {i}: HOUSEHOLD_COUNT cannot be negative.", dup_in_file
+            return None, None, f"Row {i}: HOUSEHOLD_COUNT cannot be negative.", dup_in_file
+
+        try:
+            hhs_append(hh)
+        except OverflowError:
+            return None, None, f"Row {i}: HOUSEHOLD_COUNT is too large.", dup_in_file
+        nats_append(nat)
+
+    if not nats:
+        return None, None, "No valid data rows found (after removing duplicates).", dup_in_file
+
+    return nats, hhs, None, dup_in_file
+
+
+@lru_cache(maxsize=2)
+def _iso_second(t: int) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))
+
+
+def iso_now() -> str:
+    """Current UTC time as ISO-8601, formatted at most once per second."""
+    return _iso_second(int(time.time()))
+
+
+def hash_upload(f) -> str:
+    """sha256 of the raw upload; leaves the file rewound for parsing."""
+    digest = hashlib.file_digest(f, "sha256").hexdigest()
+    f.seek(0)
+    return digest
+
+
+def parse_upload(f) -> Tuple[Optional[List[str]], Optional[array], Optional[str], int]:
+    """parse_csv_file straight from the uploaded (spooled) binary file."""
+    # The text reader drops the BOM and normalizes line endings.
+    text_stream = io.TextIOWrapper(f, encoding="utf-8-sig", errors="replace")
+    try:
+        return parse_csv_file(text_stream)
+    finally:
+        text_stream.detach()  # leave the file open for UploadFile to close
+
+
+def describe_rows(
+    nats: List[str],
+    hhs: array,
+    outcome: dict,
+    batch_id: int,
+    client_name: str,
+    client_project: str,
+    cdate: date,
+) -> Tuple[List[str], List[dict]]:
+    """
+    Per-row status/notes from the master upsert outcome.
+    Returns: (notes_preview, audit_rows); audit_rows is empty unless STORE_ROW_AUDIT.
+    """
+    # Per-row status/notes only feed the audit rows and the notes preview;
+    # once the preview is full and auditing is off, nothing is left to do.
+    notes_preview = []
+    audit_rows = []
+    preview_full = False
+    for nat, hh in zip(nats, hhs):
+        if preview_full and not STORE_ROW_AUDIT:
+            break
+
+        inserted, last_by, last_proj, last_date = outcome.get(nat, (None, None, None, None))
+
+        if inserted is None:
+            status = "master_skipped"
+            note = f"Not applied to master (older/equal date). Current master: {last_by} ({last_proj}) on {last_date}."
+        elif inserted:
+            status = "master_inserted"
+            note = "Inserted new EA into master."
+        else:
+            status = "master_updated"
+            note = f"Master updated (newer date). Previous: {last_by} ({last_proj}) on {last_date}."
+
+        # Optional per-row audit (OFF by default to save DB space)
+        if STORE_ROW_AUDIT:
+            audit_rows.append({
+                "bid": batch_id, "nat": nat, "hh": hh,
+                "cn": client_name, "cp": client_project, "cd": cdate,
+                "st": status, "note": note
+            })
+
+        if not preview_full:
+            notes_preview.append(f"{nat}: {note}")
+            preview_full = len(notes_preview) >= 15
+
+    return notes_preview, audit_rows
+
+
+# ----------------------------
+# SQL (upload path)
+# ----------------------------
+# Built once at import; the engine's compiled-statement cache and asyncpg's
+# prepared-statement cache then see the same statements on every request.
+SQL_SYNC_COMMIT_OFF = text("SET LOCAL synchronous_commit = off")
+
+SQL_INSERT_BATCH = text("""
+    INSERT INTO upload_batches
+      (client_name, client_project, collection_date, file_hash, file_name,
+       total_rows, valid_rows, invalid_rows, duplicate_in_file,
+       master_inserted, master_updated, master_skipped)
+    VALUES
+      (:cn, :cp, :cd, :fh, :fn,
+       :tr, :vr, :ir, :df,
+       0, 0, 0)
+    ON CONFLICT (client_name, client_project, collection_date, file_hash) DO NOTHING
+    RETURNING id, created_at;
+""")
+
+SQL_SELECT_EXISTING_BATCH = text("""
+    SELECT id, created_at
+    FROM upload_batches
+    WHERE client_name=:cn AND client_project=:cp AND collection_date=:cd AND file_hash=:fh
+    LIMIT 1
+""")
+
+SQL_CREATE_STAGING = text("CREATE TEMP TABLE stg_ea (nat TEXT, hh INTEGER) ON COMMIT DROP")
+
+# One round trip for the whole master step. All CTEs see the same snapshot,
+# so `prev` is the master state from before the upsert (for the notes), and
+# the batch counters are written by the same statement.
+# Returns one row per staged EA: inserted is TRUE/FALSE when applied and
+# NULL when skipped; the last_updated_* columns are the previous owner.
+SQL_UPSERT_MASTER_FROM_STAGING = text("""
+    WITH prev AS (
+      SELECT f.NAT_EA_SN AS nat, f.last_updated_by, f.last_updated_project, f.last_updated_date
+      FROM ea_frame f JOIN stg_ea s ON s.nat = f.NAT_EA_SN
+    ), applied AS (
+      INSERT INTO ea_frame AS f
+        (NAT_EA_SN, HOUSEHOLD_COUNT, last_updated_by, last_updated_project, last_updated_date, last_updated_at)
+      SELECT s.nat, s.hh, CAST(:cn AS TEXT), CAST(:cp AS TEXT), CAST(:cd AS DATE), NOW()
+      FROM stg_ea s
+      ON CONFLICT (NAT_EA_SN) DO UPDATE
+      SET HOUSEHOLD_COUNT=EXCLUDED.HOUSEHOLD_COUNT,
+          last_updated_by=EXCLUDED.last_updated_by,
+          last_updated_project=EXCLUDED.last_updated_project,
+          last_updated_date=EXCLUDED.last_updated_date,
+          last_updated_at=NOW()
+      WHERE f.last_updated_date IS NULL OR EXCLUDED.last_updated_date > f.last_updated_date
+      RETURNING f.NAT_EA_SN AS nat, (f.xmax = 0) AS inserted
+    ), counters AS (
+      UPDATE upload_batches
+      SET master_inserted=(SELECT count(*) FROM applied WHERE inserted),
+          master_updated=(SELECT count(*) FROM applied WHERE NOT inserted),
+          master_skipped=CAST(:vr AS INTEGER) - (SELECT count(*) FROM applied)
+      WHERE id=:bid
+    )
+    SELECT COALESCE(a.nat, p.nat), a.inserted, p.last_updated_by, p.last_updated_project, p.last_updated_date
+    FROM applied a FULL JOIN prev p ON p.nat = a.nat
+""")
+
+# ea_uploads rows go in with COPY; names are the folded (lowercase) columns
+AUDIT_COPY_COLUMNS = [
+    "batch_id", "nat_ea_sn", "household_count", "client_name",
+    "client_project", "collection_date", "status", "note",
+]
 
-        rows.append((nat, hh))
+SQL_LOCK_BATCH = text("SELECT 1 FROM upload_batches WHERE id=:bid FOR UPDATE")
 
-    if not rows:
-        return None, "No valid data rows found (after removing duplicates).", dup_in_file
+SQL_DELETE_AUDIT_BATCH = text("DELETE FROM ea_uploads WHERE batch_id=:bid")
 
-    return rows, None, dup_in_file
+
+# ----------------------------
+# Deferred row audit (STORE_ROW_AUDIT=1)
+# ----------------------------
+# /upload spools the batch's audit rows to disk before committing the master
+# changes and the batch summary, then queues them; audit_worker writes them to
+# ea_uploads in the background. upload_batches already has the counts, so
+# the response doesn't wait for the audit insert. Batches that can't be
+# written yet are retried every AUDIT_RETRY_DELAY seconds; a spool file whose
+# batch never committed is dropped once past AUDIT_ORPHAN_GRACE.
+def spool_audit_rows(batch_id: int, audit_rows: List[dict]) -> str:
+    path = os.path.join(AUDIT_SPOOL_DIR, f"{batch_id}.jsonl")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for r in audit_rows:
+            f.write(json.dumps({**r, "cd": r["cd"].isoformat()}) + "\n")
+    os.replace(tmp_path, path)  # only complete files are ever replayed
+    return path
+
+
+def discard_audit_spool(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def load_spooled_audit_rows(path: str) -> List[dict]:
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            r = json.loads(line)
+            r["cd"] = date.fromisoformat(r["cd"])
+            rows.append(r)
+    return rows
+
+
+def spool_age(path: str) -> Optional[float]:
+    """Seconds since the spool file was written; None once it's gone."""
+    try:
+        return time.time() - os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+
+
+async def write_audit_rows(batch_id: int, audit_rows: List[dict], path: str) -> bool:
+    """Returns False when the batch should be retried later."""
+    if spool_age(path) is None:
+        return True  # another worker already wrote this batch
+
+    async with engine.begin() as conn:
+        # Replays must not double the rows (crash between commit and unlink,
+        # or two workers replaying the same spool file): lock the batch,
+        # then replace whatever is already stored for it.
+        if (await conn.execute(SQL_LOCK_BATCH, {"bid": batch_id})).scalar() is None:
+            # Either the upload is still committing, or it never will
+            age = spool_age(path)
+            if age is not None and age < AUDIT_ORPHAN_GRACE:
+                return False
+            logger.warning("Batch %s not found; dropping its audit spool %s", batch_id, path)
+        else:
+            await conn.execute(SQL_DELETE_AUDIT_BATCH, {"bid": batch_id})
+            raw = await conn.get_raw_connection()
+            await raw.driver_connection.copy_records_to_table(
+                "ea_uploads",
+                records=[
+                    (r["bid"], r["nat"], r["hh"], r["cn"], r["cp"], r["cd"], r["st"], r["note"])
+                    for r in audit_rows
+                ],
+                columns=AUDIT_COPY_COLUMNS,
+            )
+
+    discard_audit_spool(path)
+    return True
+
+
+async def audit_worker(queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await queue.get()
+        batch_id, audit_rows, path = item
+        try:
+            written = await write_audit_rows(batch_id, audit_rows, path)
+        except Exception:
+            logger.exception("Audit rows for batch %s not written; retrying in %ss", batch_id, AUDIT_RETRY_DELAY)
+            written = False
+        finally:
+            queue.task_done()
+
+        # Not counted by queue.join(): on shutdown the spool file is replayed
+        # by the next start instead.
+        if not written:
+            loop.call_later(AUDIT_RETRY_DELAY, queue.put_nowait, item)
+
+
+async def start_audit_worker(app: FastAPI):
+    if not STORE_ROW_AUDIT:
+        return
+
+    os.makedirs(AUDIT_SPOOL_DIR, exist_ok=True)
+    queue = asyncio.Queue()
+
+    # Re-queue batches a previous process accepted but never wrote, and sweep
+    # half-written spool files left by a crash while spooling
+    for name in sorted(os.listdir(AUDIT_SPOOL_DIR)):
+        path = os.path.join(AUDIT_SPOOL_DIR, name)
+        if name.endswith(".jsonl.tmp"):
+            age = spool_age(path)
+            if age is not None and age >= AUDIT_ORPHAN_GRACE:
+                discard_audit_spool(path)
+        elif name.endswith(".jsonl"):
+            try:
+                audit_rows = await asyncio.to_thread(load_spooled_audit_rows, path)
+            except FileNotFoundError:
+                continue  # written by another worker meanwhile
+            queue.put_nowait((int(name[:-len(".jsonl")]), audit_rows, path))
+
+    app.state.audit_queue = queue
+    app.state.audit_task = asyncio.create_task(audit_worker(queue))
+
+
+async def stop_audit_worker(app: FastAPI):
+    if not STORE_ROW_AUDIT:
+        return
+
+    await app.state.audit_queue.join()
+    app.state.audit_task.cancel()
 
 
 # ----------------------------
@@ -209,8 +584,9 @@ def home(request: Request):
 
 
 @app.get("/health")
-def health():
-    return {"status": "ok", "time": datetime.utcnow().isoformat() + "Z"}
+async def health():
+    # async: nothing here blocks, so skip the threadpool hop of a sync route
+    return {"status": "ok", "time": iso_now()}
 
 
 @app.get("/routes")
@@ -218,8 +594,52 @@ def routes():
     return [{"path": r.path, "name": r.name, "methods": sorted(list(r.methods or []))} for r in app.routes]
 
 
+# (client_name, client_project, collection_date, file_hash)
+#   -> (batch id, created_at, time.monotonic() when remembered).
+# Only touched from the event loop, so no lock is needed.
+_recent_batches: "OrderedDict[tuple, Tuple[int, datetime, float]]" = OrderedDict()
+
+
+def remember_batch(key: tuple, bid: int, created_at: datetime):
+    _recent_batches[key] = (bid, created_at, time.monotonic())
+    _recent_batches.move_to_end(key)
+    if len(_recent_batches) > RECENT_BATCHES_MAX:
+        _recent_batches.popitem(last=False)
+
+
+def recent_batch(key: tuple) -> Optional[Tuple[int, datetime]]:
+    entry = _recent_batches.get(key)
+    if entry is None:
+        return None
+    bid, created_at, seen_at = entry
+    if time.monotonic() - seen_at > RECENT_BATCH_TTL:
+        del _recent_batches[key]
+        return None
+    return bid, created_at
+
+
+def read_error_response(request: Request):
+    return templates.TemplateResponse(
+        "result.html",
+        {"request": request, "ok": False, "message": "Could not read the uploaded file. Please try again."},
+    )
+
+
+def duplicate_upload_response(request: Request, bid: int, created_at: datetime):
+    msg = (
+        "This file was already uploaded earlier for the same Client/Project/Date.\n\n"
+        f"Batch ID: {bid}\n"
+        f"Uploaded at: {created_at}\n\n"
+        "No changes were applied again."
+    )
+    return templates.TemplateResponse(
+        "result.html",
+        {"request": request, "ok": True, "message": msg, "notes": []},
+    )
+
+
 @app.post("/upload", response_class=HTMLResponse)
-def upload(
+async def upload(
     request: Request,
     client_name: str = Form(...),
     client_project: str = Form(...),
@@ -243,140 +663,108 @@ def upload(
             {"request": request, "ok": False, "message": "Collection Date is invalid. Please use the date picker."},
         )
 
+    # Hashing and parsing are CPU-bound; run them in worker threads so the
+    # event loop keeps serving other requests meanwhile.
     try:
-        raw_bytes = file.file.read()
-    except Exception:
-        return templates.TemplateResponse(
-            "result.html",
-            {"request": request, "ok": False, "message": "Could not read the uploaded file. Please try again."},
-        )
-
-    # stable hash for "same file reupload" protection
-    norm_bytes = normalize_csv_bytes(raw_bytes)
-    file_hash = sha256_hex(norm_bytes)
+        # hash of the raw upload for "same file reupload" protection; hashing
+        # is far cheaper than parsing, so re-uploads are caught before the parse
+        file_hash = await asyncio.to_thread(hash_upload, file.file)
+    except OSError:
+        return read_error_response(request)
+
+    dedupe_key = {"cn": client_name, "cp": client_project, "cd": cdate, "fh": file_hash}
+    recent_key = (client_name, client_project, cdate, file_hash)
+    existing = recent_batch(recent_key)
+    if existing is None:
+        async with engine.connect() as conn:
+            existing = (await conn.execute(SQL_SELECT_EXISTING_BATCH, dedupe_key)).fetchone()
+        if existing is not None:
+            remember_batch(recent_key, *existing)
+    if existing is not None:
+        return duplicate_upload_response(request, *existing)
+
+    # Parse straight from the uploaded (spooled) file, one line at a time.
+    try:
+        nats, hhs, err, dup_in_file = await asyncio.to_thread(parse_upload, file.file)
+    except OSError:
+        return read_error_response(request)
 
-    rows, err, dup_in_file = parse_csv_file(raw_bytes)
     if err:
         return templates.TemplateResponse("result.html", {"request": request, "ok": False, "message": err})
 
-    total_rows = len(rows) + dup_in_file
-    valid_rows = len(rows)
+    total_rows = len(nats) + dup_in_file
+    valid_rows = len(nats)
     invalid_rows = 0  # parse_csv returns errors immediately
 
-    master_inserted = 0
-    master_updated = 0
-    master_skipped = 0
-    notes_preview = []
-
-    with engine.begin() as conn:
-        # 1) Deduplicate same-file uploads (same client/project/date)
-        existing_batch = conn.execute(text("""
-            SELECT id, created_at
-            FROM upload_batches
-            WHERE client_name=:cn AND client_project=:cp AND collection_date=:cd AND file_hash=:fh
-            LIMIT 1
-        """), {"cn": client_name, "cp": client_project, "cd": cdate, "fh": file_hash}).fetchone()
-
-        if existing_batch:
-            bid, created_at = existing_batch
-            msg = (
-                "This file was already uploaded earlier for the same Client/Project/Date.\n\n"
-                f"Batch ID: {bid}\n"
-                f"Uploaded at: {created_at}\n\n"
-                "No changes were applied again."
+    audit_path = None
+    try:
+        async with engine.begin() as conn:
+            # Bulk ingest: don't wait for the WAL flush on commit. A server crash
+            # can lose the last few acknowledged uploads, but never corrupts data,
+            # and the lost batch row goes with them so a re-upload is applied again
+            # (once this worker's recent-batch entry is past RECENT_BATCH_TTL).
+            await conn.execute(SQL_SYNC_COMMIT_OFF)
+
+            # 1) Create batch record first (step 5 fills in the master counters).
+            #    ux_batch_dedupe_cov still guards against the same file arriving
+            #    twice at once (both passing the pre-parse check above).
+            inserted_batch = (await conn.execute(SQL_INSERT_BATCH, {
+                **dedupe_key, "fn": getattr(file, "filename", None),
+                "tr": total_rows, "vr": valid_rows, "ir": invalid_rows, "df": dup_in_file,
+            })).fetchone()
+
+            # 2) Lost that race: report the batch that won
+            if inserted_batch is None:
+                existing = (await conn.execute(SQL_SELECT_EXISTING_BATCH, dedupe_key)).fetchone()
+                remember_batch(recent_key, *existing)
+                return duplicate_upload_response(request, *existing)
+            batch_id, batch_created_at = inserted_batch
+
+            # 3) Stage the file's rows in a temp table with COPY: one streamed
+            #    transfer instead of binding every row into a statement.
+            #    Binary COPY straight from the parsed columns, no CSV text copy.
+            await conn.execute(SQL_CREATE_STAGING)
+            raw = await conn.get_raw_connection()  # asyncpg connection, same transaction
+            await raw.driver_connection.copy_records_to_table(
+                "stg_ea", records=zip(nats, hhs), columns=["nat", "hh"],
             )
-            return templates.TemplateResponse(
-                "result.html",
-                {"request": request, "ok": True, "message": msg, "notes": []},
+
+            # 4) Apply “safe update” rule in one statement:
+            #    update master only if collection_date is NEWER than last_updated_date
+            #    (legacy rows without last_updated_date are always updated).
+            #    The same statement returns the previous owner of each staged EA
+            #    (for the notes) and updates the batch counters.
+            outcome = {
+                nat: (inserted, last_by, last_proj, last_date)
+                for nat, inserted, last_by, last_proj, last_date in await conn.execute(
+                    SQL_UPSERT_MASTER_FROM_STAGING,
+                    {"cn": client_name, "cp": client_project, "cd": cdate, "vr": valid_rows, "bid": batch_id},
+                )
+            }
+
+            master_inserted = sum(1 for o in outcome.values() if o[0] is True)
+            master_updated = sum(1 for o in outcome.values() if o[0] is False)
+            master_skipped = len(nats) - master_inserted - master_updated
+
+            # Per-row notes (and audit rows) can be one entry per EA; build and
+            # spool them off the event loop. The spool file is written before the
+            # commit so a crash right after it can't lose the rows; it is removed
+            # below if the transaction rolls back.
+            notes_preview, audit_rows = await asyncio.to_thread(
+                describe_rows, nats, hhs, outcome, batch_id, client_name, client_project, cdate,
             )
+            if audit_rows:
+                audit_path = await asyncio.to_thread(spool_audit_rows, batch_id, audit_rows)
+    except BaseException:
+        if audit_path is not None:
+            discard_audit_spool(audit_path)
+        raise
+
+    # only after commit: a rolled-back batch must not look like a duplicate
+    remember_batch(recent_key, batch_id, batch_created_at)
 
-        # 2) Create batch record first (we'll update counts at the end)
-        batch_id = conn.execute(text("""
-            INSERT INTO upload_batches
-              (client_name, client_project, collection_date, file_hash, file_name,
-               total_rows, valid_rows, invalid_rows, duplicate_in_file,
-               master_inserted, master_updated, master_skipped)
-            VALUES
-              (:cn, :cp, :cd, :fh, :fn,
-               :tr, :vr, :ir, :df,
-               0, 0, 0)
-            RETURNING id;
-        """), {
-            "cn": client_name, "cp": client_project, "cd": cdate,
-            "fh": file_hash, "fn": getattr(file, "filename", None),
-            "tr": total_rows, "vr": valid_rows, "ir": invalid_rows, "df": dup_in_file,
-        }).fetchone()[0]
-
-        # 3) Apply “safe update” rule:
-        #    update master only if collection_date is NEWER than last_updated_date
-        for nat, hh in rows:
-            master = conn.execute(text("""
-                SELECT HOUSEHOLD_COUNT, last_updated_by, last_updated_project, last_updated_date
-                FROM ea_frame WHERE NAT_EA_SN=:nat
-            """), {"nat": nat}).fetchone()
-
-            status = "received"
-            note = None
-
-            if master is None:
-                conn.execute(text("""
-                    INSERT INTO ea_frame
-                      (NAT_EA_SN, HOUSEHOLD_COUNT, last_updated_by, last_updated_project, last_updated_date, last_updated_at)
-                    VALUES
-                      (:nat, :hh, :cn, :cp, :cd, NOW())
-                """), {"nat": nat, "hh": hh, "cn": client_name, "cp": client_project, "cd": cdate})
-                master_inserted += 1
-                status = "master_inserted"
-                note = "Inserted new EA into master."
-            else:
-                _, last_by, last_proj, last_date = master
-                last_date = last_date  # may be None for legacy rows
-
-                # If no last_date exists, treat incoming as newer
-                can_update = (last_date is None) or (cdate > last_date)
-
-                if can_update:
-                    conn.execute(text("""
-                        UPDATE ea_frame
-                        SET HOUSEHOLD_COUNT=:hh,
-                            last_updated_by=:cn,
-                            last_updated_project=:cp,
-                            last_updated_date=:cd,
-                            last_updated_at=NOW()
-                        WHERE NAT_EA_SN=:nat
-                    """), {"nat": nat, "hh": hh, "cn": client_name, "cp": client_project, "cd": cdate})
-                    master_updated += 1
-                    status = "master_updated"
-                    note = f"Master updated (newer date). Previous: {last_by} ({last_proj}) on {last_date}."
-                else:
-                    master_skipped += 1
-                    status = "master_skipped"
-                    note = f"Not applied to master (older/equal date). Current master: {last_by} ({last_proj}) on {last_date}."
-
-            # Optional per-row audit (OFF by default to save DB space)
-            if STORE_ROW_AUDIT:
-                conn.execute(text("""
-                    INSERT INTO ea_uploads
-                      (batch_id, NAT_EA_SN, HOUSEHOLD_COUNT, client_name, client_project, collection_date, status, note)
-                    VALUES
-                      (:bid, :nat, :hh, :cn, :cp, :cd, :st, :note)
-                """), {
-                    "bid": batch_id, "nat": nat, "hh": hh,
-                    "cn": client_name, "cp": client_project, "cd": cdate,
-                    "st": status, "note": note
-                })
-
-            if note and len(notes_preview) < 15:
-                notes_preview.append(f"{nat}: {note}")
-
-        # 4) Update batch counters
-        conn.execute(text("""
-            UPDATE upload_batches
-            SET master_inserted=:mi,
-                master_updated=:mu,
-                master_skipped=:ms
-            WHERE id=:bid
-        """), {"mi": master_inserted, "mu": master_updated, "ms": master_skipped, "bid": batch_id})
+    if audit_path is not None:
+        request.app.state.audit_queue.put_nowait((batch_id, audit_rows, audit_path))
 
     message = (
         f"Upload processed successfully.\n\n"
@@ -394,3 +782,15 @@ def upload(
         "result.html",
         {"request": request, "ok": True, "message": message, "notes": notes_preview},
     )
+
+
+async def _init_db_once():
+    try:
+        await init_db()
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    # One-shot schema setup, e.g. `python main.py` before starting the workers
+    asyncio.run(_init_db_once())